@@ -2,8 +2,19 @@ import streamlit as st
 import pandas as pd
 import numpy as np
 import altair as alt
+import functools
+import hashlib
+import io
+import os
 import re
-from datetime import datetime, timedelta
+from dataclasses import dataclass
+from datetime import datetime
+
+try:
+    from python_calamine import CalamineError
+    EXCEL_ENGINE = "calamine"
+except ImportError:  # optional; read_excel falls back to openpyxl
+    CalamineError, EXCEL_ENGINE = (), "openpyxl"
 
 # --- Page Setup ---
 st.set_page_config(layout="wide", page_title="Clinical Trial Dashboard")
@@ -19,42 +30,89 @@ if not (asset_buf and forms_buf and sites_buf):
     st.stop()
 
 # --- Helpers: Column Matching ---
+NON_ALNUM = re.compile(r'[^a-z0-9]+')
+
 def normalize(name: str) -> str:
-    s = str(name).lower()
-    s = re.sub(r'[^a-z0-9]', ' ', s)
-    return re.sub(r'\s+', ' ', s).strip()
+    # one pass: any run of non-alphanumerics collapses to a single space
+    return NON_ALNUM.sub(' ', str(name).lower()).strip()
+
+@functools.lru_cache(maxsize=None)
+def norm_map(columns: tuple) -> dict:
+    return {normalize(c): c for c in columns}
 
-def col(df: pd.DataFrame, *cands) -> str | None:
-    norm_map = {normalize(c): c for c in df.columns}
+def col(columns: tuple, *cands) -> str | None:
+    # normalized map is built once per column set, not once per lookup
+    nmap  = norm_map(columns)
+    ncand = [normalize(c) for c in cands]
     # exact match
-    for cand in cands:
-        nc = normalize(cand)
-        if nc in norm_map:
-            return norm_map[nc]
+    for nc in ncand:
+        if nc in nmap:
+            return nmap[nc]
     # fuzzy match
-    for cand in cands:
-        nc = normalize(cand)
-        for nm, orig in norm_map.items():
+    for nc in ncand:
+        for nm, orig in nmap.items():
             if nc in nm:
                 return orig
     return None
 
-@st.cache_data(show_spinner=False)
-def load_df(buf) -> pd.DataFrame:
-    raw = pd.read_excel(buf, header=None)
-    hdr = 0
-    for i in range(len(raw)):
-        row = raw.iloc[i].astype(str).str.lower()
-        if "subject number" in row.values and "study procedure" in row.values:
-            hdr = i
-            break
-    df = pd.read_excel(buf, header=hdr).dropna(axis=1, how="all")
+def header_names(row) -> list[str]:
+    # mirror read_excel: blank headers become "Unnamed: i", duplicates get ".n"
+    names, seen = [], {}
+    for i, v in enumerate(row):
+        # a numeric header in a float column still reads "2024", not "2024.0"
+        if isinstance(v, float) and v.is_integer():
+            v = int(v)
+        name = f"Unnamed: {i}" if pd.isna(v) or v == "" else str(v)
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        names.append(name)
+    return names
+
+HEADER_SCAN_ROWS = 30  # report headers never sit deeper than this
+
+def find_header(raw: pd.DataFrame) -> int:
+    # one vectorized pass over the preview instead of a per-row Python loop
+    low = np.char.lower(raw.head(HEADER_SCAN_ROWS).to_numpy(dtype=str))
+    hits = (low == "subject number").any(axis=1) & (low == "study procedure").any(axis=1)
+    return int(hits.argmax()) if hits.any() else 0
+
+def file_key(buf) -> str:
+    return hashlib.blake2b(buf.getvalue(), digest_size=16).hexdigest()
+
+def read_raw(data: bytes) -> pd.DataFrame:
+    # header=None so the sheet is parsed once; read_excel keeps its NA strings and cell typing
+    try:
+        return pd.read_excel(io.BytesIO(data), header=None, engine=EXCEL_ENGINE)
+    except CalamineError:  # workbooks calamine rejects may still open in openpyxl
+        return pd.read_excel(io.BytesIO(data), header=None, engine="openpyxl")
+
+# persisting to disk lets a restart skip re-parsing, but it pickles every upload
+# (subjects, sites, dates) under ~/.streamlit/cache indefinitely: no ttl or
+# max_entries applies there. Opt in with DASHBOARD_PERSIST_UPLOADS=1;
+# `streamlit cache clear` removes the stored files.
+PERSIST_UPLOADS = os.environ.get("DASHBOARD_PERSIST_UPLOADS") == "1"
+
+@st.cache_data(show_spinner=False, persist="disk" if PERSIST_UPLOADS else None)
+def load_df(key: str, _buf) -> pd.DataFrame:
+    # cached on the content digest, not the UploadedFile object
+    # one parse of the first sheet; header row located in memory
+    raw = read_raw(_buf.getvalue())
+    if raw.empty:  # blank first sheet: let column validation report it
+        return pd.DataFrame()
+    hdr = find_header(raw)
+    df = raw.iloc[hdr + 1:].set_axis(header_names(raw.iloc[hdr]), axis=1).reset_index(drop=True)
+    # columns held the header text too; re-infer now that only data rows remain
+    df = df.infer_objects().dropna(axis=1, how="all")
     return df[df.notna().any(axis=1)]
 
 # --- Load DataFrames ---
-asset_df = load_df(asset_buf)
-forms_df = load_df(forms_buf)
-sites_df = load_df(sites_buf)
+file_keys = tuple(file_key(b) for b in (asset_buf, forms_buf, sites_buf))
+asset_df = load_df(file_keys[0], asset_buf)
+forms_df = load_df(file_keys[1], forms_buf)
+sites_df = load_df(file_keys[2], sites_buf)
 
 # --- Debug: Show Detected Columns ---
 with st.expander("🔧 Detected Columns"):
@@ -63,38 +121,71 @@ with st.expander("🔧 Detected Columns"):
     st.write("Sites:",  sites_df.columns.tolist())
 
 # --- Identify Columns ---
-# Sites
-s_site       = col(sites_df, "Site Name")
-s_subj       = col(sites_df, "Subject Number")
-s_visit      = col(sites_df, "Visit Name", "Study Event")
-s_assess     = col(sites_df, "Assessment Name", "Study Procedure")
-s_id         = col(sites_df, "Assessment ID")
-s_date       = col(sites_df, "Assessment Date", "Study Procedure Date")
-s_status     = col(sites_df, "Assessment Status")
-s_status_dt  = col(sites_df, "Assessment Status Date")
-task_cols    = [c for c in sites_df.columns if "task " in c.lower() and "date" in c.lower()]
-act_raised   = col(sites_df, "Action Required - Date Raised")
-act_resolved = col(sites_df, "Action Resolved Date")
-
-# Asset report
-a_site       = col(asset_df, "Library/Site Name", "Site Name")
-a_subj       = col(asset_df, "Subject Number")
-a_visit      = col(asset_df, "Study Event", "Visit Name")
-a_assess     = col(asset_df, "Study Procedure", "Assessment Name")
-a_date       = col(asset_df, "Study Procedure Date", "Assessment Date")
-a_upload     = col(asset_df, "Upload Date")
-
-# Forms report
-f_spid       = col(forms_df, "Study Procedure ID", "Assessment ID")
-f_created    = col(forms_df, "Date Created", "Form Created Date")
-f_submitted  = col(forms_df, "Submitted Date", "Form Submitted Date")
-rev_comment  = col(forms_df, "Review Comment", "ReviewComment")
+@dataclass(frozen=True)
+class Bindings:
+    # column names resolved once per upload; downstream code never calls col()
+    s_site: str | None
+    s_subj: str | None
+    s_visit: str | None
+    s_assess: str | None
+    s_id: str | None
+    s_date: str | None
+    s_status: str | None
+    s_status_dt: str | None
+    task_cols: tuple
+    act_raised: str | None
+    act_resolved: str | None
+    a_site: str | None
+    a_subj: str | None
+    a_visit: str | None
+    a_assess: str | None
+    a_date: str | None
+    a_upload: str | None
+    f_spid: str | None
+    f_created: str | None
+    f_submitted: str | None
+    rev_comment: str | None
+
+@st.cache_data(show_spinner=False)
+def bind_columns(asset_cols: tuple, forms_cols: tuple, sites_cols: tuple) -> Bindings:
+    # keyed on the header tuples, so any upload with a known schema is a cache hit
+    names = pd.Index(sites_cols, dtype=str)
+    lower = names.str.lower()
+    tasks = names[lower.str.contains("task ", regex=False) & lower.str.contains("date", regex=False)]
+    return Bindings(
+        # Sites
+        s_site       = col(sites_cols, "Site Name"),
+        s_subj       = col(sites_cols, "Subject Number"),
+        s_visit      = col(sites_cols, "Visit Name", "Study Event"),
+        s_assess     = col(sites_cols, "Assessment Name", "Study Procedure"),
+        s_id         = col(sites_cols, "Assessment ID"),
+        s_date       = col(sites_cols, "Assessment Date", "Study Procedure Date"),
+        s_status     = col(sites_cols, "Assessment Status"),
+        s_status_dt  = col(sites_cols, "Assessment Status Date"),
+        task_cols    = tuple(tasks),
+        act_raised   = col(sites_cols, "Action Required - Date Raised"),
+        act_resolved = col(sites_cols, "Action Resolved Date"),
+        # Asset report
+        a_site       = col(asset_cols, "Library/Site Name", "Site Name"),
+        a_subj       = col(asset_cols, "Subject Number"),
+        a_visit      = col(asset_cols, "Study Event", "Visit Name"),
+        a_assess     = col(asset_cols, "Study Procedure", "Assessment Name"),
+        a_date       = col(asset_cols, "Study Procedure Date", "Assessment Date"),
+        a_upload     = col(asset_cols, "Upload Date"),
+        # Forms report
+        f_spid       = col(forms_cols, "Study Procedure ID", "Assessment ID"),
+        f_created    = col(forms_cols, "Date Created", "Form Created Date"),
+        f_submitted  = col(forms_cols, "Submitted Date", "Form Submitted Date"),
+        rev_comment  = col(forms_cols, "Review Comment", "ReviewComment"),
+    )
+
+b = bind_columns(tuple(asset_df.columns), tuple(forms_df.columns), tuple(sites_df.columns))
 
 # --- Validate Required Columns ---
 required = {
-    "Sites":  [s_site, s_subj, s_visit, s_assess, s_date],
-    "Assets": [a_site, a_subj, a_visit, a_assess, a_date, a_upload],
-    "Forms":  [f_spid, f_submitted],
+    "Sites":  [b.s_site, b.s_subj, b.s_visit, b.s_assess, b.s_date],
+    "Assets": [b.a_site, b.a_subj, b.a_visit, b.a_assess, b.a_date, b.a_upload],
+    "Forms":  [b.f_spid, b.f_submitted],
 }
 errors = []
 for name, cols in required.items():
@@ -105,62 +196,162 @@ if errors:
     st.error("❌ Missing required columns:\n" + "\n".join(errors))
     st.stop()
 
-# --- Parse Date Columns ---
-for df, cols in [
-    (sites_df, [s_date, s_status_dt, act_raised, act_resolved] + task_cols),
-    (asset_df, [a_date, a_upload]),
-    (forms_df, [f_created, f_submitted])
-]:
-    for c in cols:
-        if c in df.columns:
-            df[c] = pd.to_datetime(df[c], errors="coerce")
-
-# --- Compute Asset Delays & Merge into Sites ---
-asset_df["upload_delay"] = (asset_df[a_upload] - asset_df[a_date]).dt.days
+# --- Parse, Merge & Compute KPIs (cached per set of uploaded files) ---
 first_upload_col = "first_upload_date"
-asset_agg = (
-    asset_df
-    .groupby([a_site, a_subj, a_visit, a_assess], as_index=False)
-    .agg(
-        **{first_upload_col: (a_upload, "min")},
-        max_upload_delay=("upload_delay", "max")
+
+def share_categories(left: pd.Series, right: pd.Series) -> tuple[pd.Series, pd.Series]:
+    # one category index for both sides so joins hash int codes, not strings
+    dtype = pd.CategoricalDtype(pd.unique(pd.concat([left, right], ignore_index=True).dropna()))
+    return left.astype(dtype), right.astype(dtype)
+
+def shrink_dtypes(df: pd.DataFrame) -> pd.DataFrame:
+    # repetitive text -> category, integers -> smallest int type
+    for c in df.select_dtypes(include=["object", "string"]).columns:
+        if df[c].nunique() < len(df) // 2:
+            df[c] = df[c].astype("category")
+    for c in df.select_dtypes(include="integer").columns:
+        df[c] = pd.to_numeric(df[c], downcast="integer")
+    return df
+
+def project(df: pd.DataFrame, cols) -> pd.DataFrame:
+    # keep only the bound columns the pipeline reads, in sheet order
+    keep = {c for c in cols if c}
+    return df[[c for c in df.columns if c in keep]].copy()
+
+US_PER_DAY = 86_400_000_000
+
+def ddays(a, b) -> np.ndarray:
+    # whole days a - b (floored like .dt.days) on int64 microsecond views; NaT -> NaN
+    # us, not ns: pandas keeps far-off (mistyped) years at [s]/[us], which overflow [ns];
+    # us still keeps Excel's millisecond precision and spans years +-290k
+    # float32 holds any day count exactly at half the width of float64
+    a = np.asarray(a, dtype="datetime64[us]").view("i8")
+    b = np.asarray(b, dtype="datetime64[us]").view("i8")
+    nat = np.iinfo("i8").min
+    return np.where((a == nat) | (b == nat), np.nan, (a - b) // US_PER_DAY).astype(np.float32)
+
+# 5d 23:59:59.7 must floor to 5 like .dt.days, not round up on truncated seconds
+assert ddays(np.array(["2024-01-07T00:00:00.300"], "datetime64[ms]"),
+             np.array(["2024-01-01T00:00:00.600"], "datetime64[ms]"))[0] == 5
+
+def row_key(df: pd.DataFrame, cols: list) -> np.ndarray:
+    # one uint64 hash per row stands in for a multi-column join key
+    return pd.util.hash_pandas_object(df[cols], index=False).to_numpy()
+
+def composite_key(df: pd.DataFrame, cols: list) -> np.ndarray:
+    # pack shared category codes into one exact int64 per row; -1 if any part is missing
+    codes   = np.vstack([df[c].cat.codes.to_numpy() for c in cols])
+    missing = (codes < 0).any(axis=0)
+    try:
+        key = np.ravel_multi_index(np.where(codes < 0, 0, codes), [max(len(df[c].cat.categories), 1) for c in cols])
+    except ValueError:  # too many combinations for int64: fall back to a 63-bit hash
+        key = (row_key(df, cols) >> np.uint64(1)).astype(np.int64)
+    return np.where(missing, -1, key)
+
+@st.cache_data(show_spinner=False)
+def compute_kpis(key, _asset_df, _forms_df, _sites_df, b: Bindings):
+    # frames are skipped by the hasher (leading "_"); `key` carries the file digests
+    # every later merge, groupby and mask only touches the bound columns
+    sites_df = project(_sites_df, [b.s_site, b.s_subj, b.s_visit, b.s_assess, b.s_id, b.s_date,
+                                   b.s_status, b.s_status_dt, b.act_raised, b.act_resolved, *b.task_cols])
+    asset_df = project(_asset_df, [b.a_site, b.a_subj, b.a_visit, b.a_assess, b.a_date, b.a_upload])
+    forms_df = project(_forms_df, [b.f_spid, b.f_created, b.f_submitted, b.rev_comment])
+
+    # --- Parse Date Columns ---
+    for df, date_cols in [
+        (sites_df, [b.s_date, b.s_status_dt, b.act_raised, b.act_resolved, *b.task_cols]),
+        (asset_df, [b.a_date, b.a_upload]),
+        (forms_df, [b.f_created, b.f_submitted])
+    ]:
+        for c in date_cols:
+            # cells the reader already typed as datetimes need no inference pass
+            if c in df.columns and not pd.api.types.is_datetime64_any_dtype(df[c]):
+                df[c] = pd.to_datetime(df[c], errors="coerce")
+
+    # --- Status Flags (matched on the few categories, not on every row) ---
+    sites_df[b.s_status] = sites_df[b.s_status].astype("category")
+    in_prog_cats = [c for c in sites_df[b.s_status].cat.categories if str(c).lower() == "in progress"]
+    sites_df["_in_progress"] = sites_df[b.s_status].isin(in_prog_cats)
+
+    # --- Encode Join Keys ---
+    for sk, ak in [(b.s_site, b.a_site), (b.s_subj, b.a_subj), (b.s_visit, b.a_visit), (b.s_assess, b.a_assess)]:
+        sites_df[sk], asset_df[ak] = share_categories(sites_df[sk], asset_df[ak])
+    sites_df[b.s_id], forms_df[b.f_spid] = share_categories(sites_df[b.s_id], forms_df[b.f_spid])
+
+    # --- Shrink Dtypes (these frames live in the session cache) ---
+    for df in (sites_df, asset_df, forms_df):
+        shrink_dtypes(df)
+
+    # --- Compute Asset Delays & Attach to Sites ---
+    asset_df["upload_delay"] = pd.array(ddays(asset_df[b.a_upload], asset_df[b.a_date]), dtype="Int64")
+    # group and look up on one packed int key instead of four key columns
+    asset_key = composite_key(asset_df, [b.a_site, b.a_subj, b.a_visit, b.a_assess])
+    has_key   = asset_key >= 0
+    asset_agg = (
+        asset_df[has_key]
+        .groupby(asset_key[has_key], sort=False)
+        .agg(
+            **{first_upload_col: (b.a_upload, "min")},
+            max_upload_delay=("upload_delay", "max")
+        )
+        .reindex(composite_key(sites_df, [b.s_site, b.s_subj, b.s_visit, b.s_assess]))
     )
-)
-sites_df = sites_df.merge(
-    asset_agg,
-    how="left",
-    left_on=[s_site, s_subj, s_visit, s_assess],
-    right_on=[a_site, a_subj, a_visit, a_assess],
-)
-sites_df["max_upload_delay"] = sites_df["max_upload_delay"].fillna(0).astype(int)
-
-# --- Merge Forms by Assessment ID (include review_comment if present) ---
-merge_cols = [f_spid, f_submitted]
-rename_map = {f_spid: s_id, f_submitted: "form_submitted"}
-if rev_comment and rev_comment in forms_df.columns:
-    merge_cols.append(rev_comment)
-    rename_map[rev_comment] = "review_comment"
-forms_subset = forms_df[merge_cols].rename(columns=rename_map)
-sites_df = sites_df.merge(forms_subset, how="left", on=s_id)
-
-# --- KPI Computations ---
-today = pd.Timestamp(datetime.now().date())
-
-total_assess = sites_df[s_id].nunique()
-total_subj   = sites_df[s_subj].nunique()
-in_prog      = sites_df[sites_df[s_status].str.lower()=="in progress"][s_id].nunique()
-comp_mask    = sites_df[s_status_dt].notna()
-avg_cycle    = ((sites_df.loc[comp_mask, s_status_dt] - sites_df.loc[comp_mask, s_date]).dt.days).mean()
-late_assets  = sites_df[sites_df["max_upload_delay"] > 5][s_id].nunique()
-sites_df["task_delay"] = sites_df[task_cols].apply(
-    lambda r: (r - sites_df.loc[r.name, s_date]).dt.days.max(), axis=1
-)
-late_tasks   = sites_df[sites_df["task_delay"] > 5][s_id].nunique()
-open_actions = sites_df[
-    sites_df[act_raised].notna() & sites_df[act_resolved].isna()
-][s_id].nunique()
-sites_df["form_delay"] = (sites_df["form_submitted"] - sites_df[first_upload_col]).dt.days
-late_forms   = sites_df[sites_df["form_delay"] > 5][s_id].nunique()
+    sites_df[first_upload_col]   = asset_agg[first_upload_col].to_numpy()
+    sites_df["max_upload_delay"] = asset_agg["max_upload_delay"].to_numpy(dtype=np.int32, na_value=0)
+
+    # --- Join Forms by Assessment ID (include review_comment if present) ---
+    merge_cols = [b.f_spid, b.f_submitted]
+    rename_map = {b.f_spid: b.s_id, b.f_submitted: "form_submitted"}
+    if b.rev_comment and b.rev_comment in forms_df.columns:
+        merge_cols.append(b.rev_comment)
+        rename_map[b.rev_comment] = "review_comment"
+    forms_subset = forms_df[merge_cols].rename(columns=rename_map).set_index(b.s_id)
+    sites_df = sites_df.join(forms_subset, on=b.s_id, how="left", sort=False).reset_index(drop=True)
+
+    # --- Delay Columns ---
+    # broadcast the assessment date against the task-date block
+    delays = ddays(sites_df[list(b.task_cols)], sites_df[[b.s_date]])
+    sites_df["task_delay"] = np.fmax.reduce(delays, axis=1) if b.task_cols else np.nan
+    sites_df["form_delay"] = ddays(sites_df["form_submitted"], sites_df[first_upload_col])
+
+    # --- KPI Computations ---
+    # all per-assessment counts in one pass over the assessment ID
+    flags = pd.DataFrame({
+        "in_prog":      sites_df["_in_progress"],
+        "late_assets":  sites_df["max_upload_delay"] > 5,
+        "late_tasks":   sites_df["task_delay"] > 5,
+        "open_actions": sites_df[b.act_raised].notna() & sites_df[b.act_resolved].isna(),
+        "late_forms":   sites_df["form_delay"] > 5,
+    }).groupby(sites_df[b.s_id], observed=True, sort=False).any()
+    kpis = flags.sum().to_dict()
+    kpis["total_assess"] = len(flags)
+    kpis["total_subj"]   = sites_df[b.s_subj].nunique()
+    # NaN where either date is missing, so incomplete rows drop out of the mean
+    kpis["avg_cycle"]    = pd.Series(ddays(sites_df[b.s_status_dt], sites_df[b.s_date]), dtype="float64").mean()
+    return asset_df, forms_df, sites_df, kpis
+
+asset_df, forms_df, sites_df, kpis = compute_kpis(file_keys, asset_df, forms_df, sites_df, b)
+total_assess, total_subj, in_prog, avg_cycle = (
+    kpis[k] for k in ("total_assess", "total_subj", "in_prog", "avg_cycle"))
+late_assets, late_tasks, open_actions, late_forms = (
+    kpis[k] for k in ("late_assets", "late_tasks", "open_actions", "late_forms"))
+today     = pd.Timestamp(datetime.now().date())
+comp_mask = sites_df[b.s_status_dt].notna()
+
+# --- Helpers: Display ---
+TABLE_ROW_CAP = 200
+
+@st.cache_data(show_spinner=False)
+def table_csv(key, name: str, _df: pd.DataFrame) -> bytes:
+    # tables are a pure function of the uploads, so the CSV is built once per upload set
+    return _df.to_csv(index=False).encode()
+
+def show_table(df: pd.DataFrame, name: str, height: int, cap: int = TABLE_ROW_CAP):
+    # only the first rows are serialized to the browser; the rest is a CSV download
+    st.dataframe(df.head(cap).reset_index(drop=True), height=height)
+    if len(df) > cap:
+        st.caption(f"Showing the first {cap} of {len(df)} rows.")
+        st.download_button(f"Download full {name}.csv", table_csv(file_keys, name, df), file_name=f"{name}.csv")
 
 # --- Display Restored KPIs ---
 st.header("Key Metrics")
@@ -186,17 +377,18 @@ st.caption("Number of assessments delayed ≥5 days, by site and delay type.")
 # Recompute site_delays
 site_delays = (
     sites_df
-    .groupby(s_site)
-    .agg(
-        assets_late=("max_upload_delay", lambda s: (s > 5).sum()),
-        tasks_late =("task_delay",        lambda s: (s > 5).sum())
+    .assign(
+        assets_late=sites_df["max_upload_delay"] > 5,
+        tasks_late =sites_df["task_delay"] > 5,
     )
+    .groupby(b.s_site, sort=False, observed=True)[["assets_late", "tasks_late"]]
+    .sum()
     .reset_index()
 )
 
 # Melt to long form
 delays_melted = site_delays.melt(
-    id_vars=[s_site],
+    id_vars=[b.s_site],
     value_vars=["assets_late", "tasks_late"],
     var_name="Delay Type",
     value_name="Delayed Count"
@@ -207,10 +399,10 @@ chart = (
     alt.Chart(delays_melted)
        .mark_bar()
        .encode(
-           y=alt.Y(f"{s_site}:N", sort='-x', title="Site"),
+           y=alt.Y(f"{b.s_site}:N", sort='-x', title="Site"),
            x=alt.X("Delayed Count:Q", title="Count of Delayed Assessments"),
            color=alt.Color("Delay Type:N", title="Type of Delay"),
-           tooltip=[s_site, "Delay Type", "Delayed Count"]
+           tooltip=[b.s_site, "Delay Type", "Delayed Count"]
        )
        .properties(height=400)
 )
@@ -218,10 +410,15 @@ chart = (
 st.altair_chart(chart, use_container_width=True)
 
 # --- 🚩 Action‑Type Breakdown ---
-if rev_comment and "review_comment" in sites_df.columns:
+if b.rev_comment and "review_comment" in sites_df.columns:
     st.subheader("🔍 Top 3 QC Issue Reasons")
-    top3 = sites_df["review_comment"].value_counts().head(3).reset_index()
-    top3.columns = ["Reason","Count"]
+    # count on category codes, then rank only the few distinct reasons
+    reason = sites_df["review_comment"].astype("category")
+    codes  = reason.cat.codes.to_numpy()
+    counts = np.bincount(codes[codes >= 0], minlength=len(reason.cat.categories))
+    top    = np.argsort(-counts, kind="stable")[:3]
+    top    = top[counts[top] > 0]
+    top3 = pd.DataFrame({"Reason": reason.cat.categories[top], "Count": counts[top]})
     st.altair_chart(
         alt.Chart(top3).mark_bar().encode(
             x=alt.X("Reason:N", title="Reason"),
@@ -237,61 +434,66 @@ st.caption("Assessments still ‘In Progress’ that have not yet had any assets
 
 # only those truly missing any upload
 no_asset_mask = (
-    (sites_df[s_status].str.lower() == "in progress") &
+    sites_df["_in_progress"] &
     sites_df[first_upload_col].isna()
 )
 
 no_asset_df = sites_df.loc[
     no_asset_mask, 
-    [s_site, s_subj, s_visit, s_assess, s_date]
+    [b.s_site, b.s_subj, b.s_visit, b.s_assess, b.s_date]
 ]
 
-st.dataframe(no_asset_df.reset_index(drop=True), height=250)
+show_table(no_asset_df, "no_asset_assessments", height=250)
 
 # --- ⏱️ Visit‑Window Adherence ---
 st.subheader("⏱️ Visits Outside Allowed Window")
 st.caption("How many scheduled visits happened too early or too late relative to the protocol‑specified window around the target day.Week 4 ± 10 days; Month 6 ± 14 days.")
-baseline = sites_df[sites_df[s_assess]=="Baseline"][[s_site,s_subj,s_date]].rename(columns={s_date:"baseline"})
-vw = sites_df.merge(baseline, on=[s_site,s_subj], how="left")
-vw["days_from_base"] = (vw[s_date] - vw["baseline"]).dt.days
-def out_of_window(r):
-    name = r[s_assess].lower()
-    if "week 4" in name:
-        tol, offset = 10, 28
-    elif "month 6" in name:
-        tol, offset = 14, 182
-    else:
-        return False
-    return abs(r["days_from_base"] - offset) > tol
-vw["out_of_window"] = vw.apply(out_of_window, axis=1)
-pct_out = vw["out_of_window"].mean()*100
+# baseline date per (site, subject), looked up on the packed key instead of a self-merge
+pair      = composite_key(sites_df, [b.s_site, b.s_subj])
+is_base   = (sites_df[b.s_assess] == "Baseline").to_numpy() & (pair >= 0)
+base_date = sites_df.loc[is_base, b.s_date].groupby(pair[is_base], sort=False).first()
+days_from_base = ddays(sites_df[b.s_date], base_date.reindex(pair))
+# (name fragment, target day, tolerance) per windowed visit; first match wins
+VISIT_WINDOWS = [("week 4", 28, 10), ("month 6", 182, 14)]
+# match on the few lower-cased assessment categories, then broadcast by code
+visit  = sites_df[b.s_assess].astype("category")
+names  = visit.cat.categories.astype(str).str.lower()
+codes  = visit.cat.codes.to_numpy()
+hits   = [np.asarray(names.str.contains(frag, regex=False))[codes] & (codes >= 0) for frag, _, _ in VISIT_WINDOWS]
+offset = np.select(hits, [o for _, o, _ in VISIT_WINDOWS], np.nan)
+tol    = np.select(hits, [t for _, _, t in VISIT_WINDOWS], np.nan)
+# NaN offsets/tolerances and missing baselines compare False
+pct_out = (np.abs(days_from_base - offset) > tol).mean()*100
 st.metric("% Visits Outside Window", f"{pct_out:.1f}%")
 
 # --- 🏴‍☠️ Late Sites Table ---
 st.subheader("🏴‍☠️ Assessments with Asset Delay >5 days")
 st.caption("Grouped by site.")
-late_df = sites_df[sites_df["max_upload_delay"] > 5][
-    [s_site, s_subj, s_visit, s_assess, s_date, first_upload_col, "max_upload_delay"]
+# select rows and displayed columns in one step so no full-width copy is made
+late_df = sites_df.loc[
+    sites_df["max_upload_delay"] > 5,
+    [b.s_site, b.s_subj, b.s_visit, b.s_assess, b.s_date, first_upload_col, "max_upload_delay"]
 ].rename(columns={
     first_upload_col: "First Upload Date",
     "max_upload_delay": "Upload Delay (days)"
 })
-st.dataframe(late_df.reset_index(drop=True), height=300)
+late_cap = st.number_input("Rows to show", min_value=10, max_value=5000, value=TABLE_ROW_CAP, step=50, key="late_cap")
+show_table(late_df, "late_asset_assessments", height=300, cap=int(late_cap))
 
 # --- 🕒 Most Recent Activity (hide index) ---
 st.subheader("🕒 Most Recent Activity")
 tabA,tabB,tabC = st.tabs(["Assets","Forms","Assessments"])
 with tabA:
     st.write("### Recent Asset Uploads")
-    ra = asset_df.sort_values(a_upload, ascending=False).head(5)
-    st.table(ra[[a_site,a_subj,a_visit,a_assess,a_date,a_upload,"upload_delay"]].reset_index(drop=True))
+    ra = asset_df.nlargest(5, b.a_upload)
+    st.table(ra[[b.a_site,b.a_subj,b.a_visit,b.a_assess,b.a_date,b.a_upload,"upload_delay"]].reset_index(drop=True))
 with tabB:
     st.write("### Recent Form Submissions")
-    rf = forms_df.sort_values(f_submitted, ascending=False).head(5)
-    st.table(rf[[f_spid,f_created,f_submitted]].reset_index(drop=True))
+    rf = forms_df.nlargest(5, b.f_submitted)
+    st.table(rf[[b.f_spid,b.f_created,b.f_submitted]].reset_index(drop=True))
 with tabC:
     st.write("### Recent Assessment Completions")
-    rc = sites_df[comp_mask].sort_values(s_status_dt, ascending=False).head(5)
-    st.table(rc[[s_id,s_date,s_status_dt]].reset_index(drop=True))
+    rc = sites_df[comp_mask].nlargest(5, b.s_status_dt)
+    st.table(rc[[b.s_id,b.s_date,b.s_status_dt]].reset_index(drop=True))
 
 st.success("✅ Dashboard loaded successfully!")